@@ -0,0 +1,78 @@
+# Benchmark of memoized serialization on a generated library
+# resembling real ones: connector series and resistor arrays,
+# where parts of a family share fields, pins and body outline.
+#
+# python benchmark.py [FAMILY_SIZE]
+
+import sys
+from time import perf_counter
+import sexpdata
+import kicad_backport
+
+PROP = '(property "{name}" "{text}" (id {id}) (at {x} {y} 0) (effects (font (size 1.27 1.27)){hide}))'
+PIN = ('(pin passive line (at {x} {y} {angle}) (length 2.54) '
+       '(name "{name}" (effects (font (size 1.27 1.27)))) '
+       '(number "{number}" (effects (font (size 1.27 1.27)))))')
+
+
+def symbol(name, ref, n_pins, rows, pitch):
+    # pins are anchored at the top, so pin N sits at the same place in
+    # every member of a family, as in most generated libraries
+    height = pitch * ((n_pins + rows - 1) // rows)
+    props = [
+        PROP.format(name='Reference', text=ref, id=0, x=0, y=2.54, hide=''),
+        PROP.format(name='Value', text=name, id=1, x=0, y=-height - 2.54, hide=''),
+        PROP.format(name='Footprint', text='', id=2, x=0, y=0, hide=' hide'),
+        PROP.format(name='Datasheet', text='~', id=3, x=0, y=0, hide=' hide'),
+        PROP.format(name='ki_keywords', text='generated', id=4, x=0, y=0, hide=' hide'),
+        PROP.format(name='ki_description', text=f'{name} generated part', id=5, x=0, y=0, hide=' hide'),
+    ]
+    body = [f'(rectangle (start -2.54 1.27) (end 2.54 {1.27 - height}) '
+            '(stroke (width 0.254)) (fill (type background)))']
+    for n in range(n_pins):
+        row, column = n // rows, n % rows
+        x = -5.08 if column == 0 else 5.08
+        body.append(PIN.format(x=x, y=-pitch * row, angle=0 if column == 0 else 180,
+                               name='~', number=n + 1))
+    return (f'(symbol "{name}" (in_bom yes) (on_board yes) {" ".join(props)} '
+            f'(symbol "{name}_0_1" {body[0]}) (symbol "{name}_1_1" {" ".join(body[1:])}))')
+
+
+def library(family_size):
+    symbols = []
+    for n in range(2, 2 + family_size):
+        symbols.append(symbol(f'Conn_01x{n:02}', 'J', n, 1, 2.54))
+        symbols.append(symbol(f'Conn_02x{n:02}', 'J', 2 * n, 2, 2.54))
+        symbols.append(symbol(f'R_Array_{n:02}', 'RN', 2 * n, 2, 5.08))
+    return f'(kicad_symbol_lib (version 20200629) (host kicad_symbol_editor "bench") {" ".join(symbols)})'
+
+
+def run(lib, memo, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        text = lib.serialize_lib(memo=memo)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, text
+
+
+def main():
+    family_size = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    lib = kicad_backport.Library(sexpdata.loads(library(family_size))[1:])
+    plain, expected = run(lib, None)
+    # fresh memo for every run, so the library is formatted from scratch
+    memo_time = None
+    for _ in range(5):
+        memo = kicad_backport.SerializeMemo()
+        elapsed, text = run(lib, memo, 1)
+        assert text == expected
+        memo_time = elapsed if memo_time is None else min(memo_time, elapsed)
+    print(f'{len(lib.symbols)} symbols')
+    print(f'plain {plain * 1000:8.2f} ms')
+    print(f'memo  {memo_time * 1000:8.2f} ms')
+    memo.print_stats()
+
+
+if __name__ == '__main__':
+    main()
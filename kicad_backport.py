@@ -7,13 +7,173 @@
 
 import sys
 import os
-from time import time
+import io
+import re
+import hashlib
+import pickle
+import tempfile
+import shutil
+import csv
+import json
+import argparse
+import importlib.util
+import tarfile
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import time, localtime, perf_counter
 import sexpdata
 
+NM_PER_MM = 1000000
+NM_PER_MIL = 25400
+
+
+class Nm(int):
+    """Length in integer nanometers, decoded straight from a mm token"""
+    __slots__ = ()
+
+
 def mils(pos):
+    if type(pos) is Nm:
+        # Truncate towards zero the same way int() does for floats
+        return pos // NM_PER_MIL if pos >= 0 else -(-pos // NM_PER_MIL)
     return int(pos * 1000 / 25.4)
 
 
+# Fixed-point parser
+# Same result as sexpdata.loads on KiCad files, except numbers in
+# positional contexts are decoded to Nm without going through float, so
+# that mils() becomes integer arithmetic. [ ] brackets and ' quoting,
+# which KiCad doesn't write, are not supported.
+
+# list head -> number of leading numeric arguments holding a length in mm
+fixed_point_args = {
+    'at': 2,  # third one is angle
+    'xy': 2,
+    'start': 2,
+    'end': 2,
+    'center': 2,
+    'length': 1,
+    'radius': 1,
+    'size': 2,
+    'width': 1
+}
+
+# Groups: opening, closing parenthesis, quoted string, plain decimal
+# number, other atom. A ; comment to end of line matches no group.
+_token_re = re.compile(r'''
+    (\()
+  | (\))
+  | ("(?:[^"\\]|\\.)*")
+  | ([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))(?![^\s()";])
+  | ([^\s()";]+)
+  | ;[^\n]*
+''', re.S | re.X)
+_escape_re = re.compile(r'\\.', re.S)
+_fixed_re = re.compile(r'([+-]?)([0-9]*)(?:\.([0-9]*))?$')
+
+
+def _unescape(match):
+    return sexpdata.String.unquote(match.group())
+
+
+def parse_atom(token):
+    # Same rules as sexpdata.Parser.atom
+    if token == 'nil':
+        return []
+    if token == 't':
+        return True
+    try:
+        return int(token)
+    except ValueError:
+        try:
+            return float(token)
+        except ValueError:
+            return sexpdata.Symbol(token)
+
+
+def parse_nm(token):
+    m = _fixed_re.match(token)
+    if not m or not (m.group(2) or m.group(3)):
+        # exponent form or not a number at all
+        value = parse_atom(token)
+        if type(value) in (int, float):
+            return Nm(round(value * NM_PER_MM))
+        return value
+    sign, whole, frac = m.groups()
+    frac = frac or ''
+    value = int(whole or '0') * NM_PER_MM + int(frac[:6].ljust(6, '0'))
+    if len(frac) > 6 and frac[6] >= '5':
+        # round digits beyond nanometers, they come from float noise
+        # like 15.239999999999998
+        value += 1
+    return Nm(-value if sign == '-' else value)
+
+
+def loads_fixed(text, symbols=None, lengths=None):
+    """Parse text, see above.
+
+    symbols and lengths are decoded atom caches, pass the same dicts to
+    calls parsing parts of one file.
+    """
+    stack = []
+    current = []
+    n_fixed = 0  # positional arguments left to decode in current list
+    # Symbols and lengths repeat a lot, each distinct one is decoded once
+    if symbols is None:
+        symbols = {}
+    if lengths is None:
+        lengths = {}
+    for opening, closing, string, number, atom in _token_re.findall(text):
+        if opening:
+            stack.append((current, n_fixed))
+            current = []
+            n_fixed = 0
+        elif closing:
+            if not stack:
+                raise ValueError('Unexpected closing parenthesis')
+            sub = current
+            current, n_fixed = stack.pop()
+            current.append(sub)
+        elif number:
+            if n_fixed:
+                n_fixed -= 1
+                value = lengths.get(number)
+                if value is None:
+                    value = lengths[number] = parse_nm(number)
+                current.append(value)
+            elif '.' in number:
+                current.append(float(number))
+            else:
+                current.append(int(number))
+        elif string:
+            string = string[1:-1]
+            if '\\' in string:
+                string = _escape_re.sub(_unescape, string)
+            current.append(string)
+        elif atom:
+            if n_fixed and current:
+                # exponent form
+                n_fixed -= 1
+                current.append(parse_nm(atom))
+                continue
+            value = symbols.get(atom)
+            if value is None:
+                value = parse_atom(atom)
+                if type(value) is sexpdata.Symbol:
+                    symbols[atom] = value
+            if not current:
+                # list head
+                n_fixed = fixed_point_args.get(atom, 0)
+            current.append(value)
+    if stack:
+        raise ValueError('Missing closing parenthesis')
+    if not current:
+        raise ValueError('No expression')
+    return current[0]
+
+
 class Effects:
     def __init__(self, body=None):
         # effects.font.size
@@ -52,6 +212,10 @@ class Effects:
                 if effect.value() == 'hide':
                     self.hide = True
 
+    def key(self):
+        return (tuple(self.font_size), self.font_italic, self.font_bold, self.font_var,
+                self.hide, self.justify_x, self.justify_y)
+
 
 class Property:
     def __init__(self, body):
@@ -77,6 +241,9 @@ class Property:
             elif e_type == 'effects':
                 self.effects = Effects(entry[1:])
 
+    def lib_key(self):
+        return self.text, self.at, self.effects.key(), self.name
+
     def serialize_lib(self, print_text=True):
         x = mils(self.at[0])
         y = mils(self.at[1])
@@ -173,6 +340,9 @@ class Pen:
             return False
         return True
 
+    def lib_key(self):
+        return self.n_unit, self.n_subunit, self.stroke_width, self.fill_type
+
     def lib_get_stroke_width(self):
         return mils(self.stroke_width)
 
@@ -199,6 +369,9 @@ class Rectangle(Pen):
             else:
                 self.parse_entry(entry)
 
+    def lib_key(self):
+        return super().lib_key() + (self.start, self.end)
+
     def serialize_lib(self):
         start_x = mils(self.start[0])
         start_y = mils(self.start[1])
@@ -235,6 +408,10 @@ class Arc(Pen):
             else:
                 self.parse_entry(entry)
 
+    def lib_key(self):
+        return super().lib_key() + (self.start, self.end, self.radius_at,
+                                    self.radius_len, self.radius_angles)
+
     def serialize_lib(self):
         r_x = mils(self.radius_at[0])
         r_y = mils(self.radius_at[1])
@@ -265,6 +442,9 @@ class Circle(Pen):
             else:
                 self.parse_entry(entry)
 
+    def lib_key(self):
+        return super().lib_key() + (self.center, self.radius)
+
     def serialize_lib(self):
         x = mils(self.center[0])
         y = mils(self.center[1])
@@ -287,15 +467,145 @@ class Polyline(Pen):
             else:
                 self.parse_entry(entry)
 
-    def serialize_lib(self):
-        n_pts = len(self.pts)
-        #        print(self.pts)
-        points = ' '.join(map(lambda x: str(mils(x)), [item for sublist in self.pts for item in sublist]))
+    def lib_key(self):
+        return super().lib_key() + (tuple(self.pts),)
+
+    def serialize_lib(self, simplifier=None):
+        pts = [(mils(x), mils(y)) for x, y in self.pts]
+        if simplifier:
+            pts = simplifier.simplify(pts, self.fill_type != 'none')
+        n_pts = len(pts)
+        points = ' '.join(f'{x} {y}' for x, y in pts)
         stroke_width = self.lib_get_stroke_width()
         fill_type = self.lib_get_fill_type()
         return f'P {n_pts} {self.n_unit} {self.n_subunit} {stroke_width} {points} {fill_type}'
 
 
+class PolylineSimplifier:
+    """Drops redundant polyline points once they are in integer mils.
+
+    Repeated points and points inside a straight run are always removed,
+    that doesn't change the drawing. With tolerance, outlines of unfilled
+    polylines are further reduced by Douglas-Peucker: points closer than
+    tolerance mils to the simplified line are dropped. Filled polylines
+    keep their exact outline.
+    """
+    def __init__(self, tolerance=0):
+        self.tolerance = tolerance
+        self.points_in = 0
+        self.points_out = 0
+
+    def simplify(self, pts, filled=False):
+        result = []
+        for p in pts:
+            if result and p == result[-1]:
+                continue
+            if len(result) >= 2:
+                a = result[-2]
+                b = result[-1]
+                abx = b[0] - a[0]
+                aby = b[1] - a[1]
+                bpx = p[0] - b[0]
+                bpy = p[1] - b[1]
+                # b is on the straight run a-p if ab and bp are collinear
+                # and point the same way, it's not if the line turns back
+                if abx * bpy == aby * bpx and abx * bpx + aby * bpy > 0:
+                    result[-1] = p
+                    continue
+            result.append(p)
+        if len(result) == 1 and len(pts) > 1:
+            # keep degenerate polyline a line
+            result.append(result[0])
+        if self.tolerance and not filled and len(result) > 2:
+            result = self.douglas_peucker(result)
+        self.points_in += len(pts)
+        self.points_out += len(result)
+        return result
+
+    def douglas_peucker(self, pts):
+        keep = [False] * len(pts)
+        keep[0] = keep[-1] = True
+        tol2 = self.tolerance * self.tolerance
+        stack = [(0, len(pts) - 1)]
+        while stack:
+            first, last = stack.pop()
+            ax, ay = pts[first]
+            bx, by = pts[last]
+            dx = bx - ax
+            dy = by - ay
+            len2 = dx * dx + dy * dy
+            max_d2 = -1
+            index = 0
+            for i in range(first + 1, last):
+                px, py = pts[i]
+                if len2:
+                    # squared distance to the line, times len2
+                    cross = dx * (py - ay) - dy * (px - ax)
+                    d2 = cross * cross
+                else:
+                    # closed run, distance to its end point
+                    d2 = (px - ax) ** 2 + (py - ay) ** 2
+                if d2 > max_d2:
+                    max_d2 = d2
+                    index = i
+            if index and max_d2 > tol2 * (len2 or 1):
+                keep[index] = True
+                stack.append((first, index))
+                stack.append((index, last))
+        return [p for p, k in zip(pts, keep) if k]
+
+
+class SerializeMemo:
+    """Bounded LRU memo of serialized fields and drawing records.
+
+    Elements are keyed on their parsed values (lib_key()), so identical
+    fields, pins and pen primitives repeated across symbols are formatted
+    once. Safe to share between threads (hit counts are then approximate),
+    but not between fixed and float parsing: Nm and plain numbers of the
+    same value make equal keys.
+    """
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # element type -> count
+        self.hits = {}
+        self.misses = {}
+
+    def serialize_lib(self, el, *args):
+        cls = type(el)
+        key = cls, args, el.lib_key()
+        cache = self.cache
+        text = cache.get(key)
+        if text is not None:
+            try:
+                cache.move_to_end(key)
+            except KeyError:
+                # evicted by another thread meanwhile
+                pass
+            self.hits[cls] = self.hits.get(cls, 0) + 1
+            return text
+        text = el.serialize_lib(*args)
+        self.misses[cls] = self.misses.get(cls, 0) + 1
+        cache[key] = text
+        while len(cache) > self.maxsize:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        return text
+
+    def stats(self):
+        """[(element type name, hits, misses)]"""
+        types = sorted(set(self.hits) | set(self.misses), key=lambda cls: cls.__name__)
+        return [(cls.__name__, self.hits.get(cls, 0), self.misses.get(cls, 0))
+                for cls in types]
+
+    def print_stats(self, f=sys.stdout):
+        for name, hits, misses in self.stats():
+            f.write(f'{name:10} {hits:9} hits {misses:9} misses '
+                    f'{100 * hits / (hits + misses):5.1f}%\n')
+
+
 class Pin:
     pin_type_map = {
         'input': 'I',
@@ -361,6 +671,11 @@ class Pin:
                 if e_type == 'hide':
                     self.hidden = True
 
+    def lib_key(self):
+        return (self.n_unit, self.n_subunit, self.at, self.length, self.name,
+                self.name_effects.key(), self.number, self.number_effects.key(),
+                self.hidden, self.pin_type, self.pin_style)
+
     def serialize_lib(self):
         x = mils(self.at[0])
         y = mils(self.at[1])
@@ -513,7 +828,7 @@ class Symbol:
             else:
                 print(f'Unknown symbol entry: {e_type}')
 
-    def serialize_lib(self, cache_lib=False):
+    def serialize_lib(self, cache_lib=False, simplifier=None, memo=None):
         pin_numbers_offset = mils(self.pin_numbers_offset)
         pin_numbers_show = 'N' if self.pin_numbers_hide else 'Y'
         pin_names_offset = mils(self.pin_names_offset)
@@ -552,14 +867,19 @@ class Symbol:
             n_units = max(units)
         else:
             n_units = 1
+        if memo:
+            fmt = memo.serialize_lib
+        else:
+            def fmt(el, *args):
+                return el.serialize_lib(*args)
         lines = ['#',
                  f'# {name}', '#',
                  f'DEF {name} {self.reference.text} {pin_numbers_offset} {pin_names_offset} {pin_numbers_show} ' +
                  f'{pin_names_show} {n_units} {locked} {power}',
-                 f'F0 {self.reference.serialize_lib()}',
-                 f'F1 {self.value.serialize_lib()}',
-                 f'F2 {self.footprint.serialize_lib()}',
-                 f'F3 {self.datasheet.serialize_lib(False)}']
+                 f'F0 {fmt(self.reference)}',
+                 f'F1 {fmt(self.value)}',
+                 f'F2 {fmt(self.footprint)}',
+                 f'F3 {fmt(self.datasheet, False)}']
         fline = 4
         # for addl_prop in self.addl_properties:
         #    lines.append(f'F{fline} {addl_prop.serialize_lib()}')
@@ -573,17 +893,18 @@ class Symbol:
             lines.append('$ENDFPLIST')
         lines.append('DRAW')
         for el in arcs:
-            lines.append(el.serialize_lib())
+            lines.append(fmt(el))
         for el in circles:
-            lines.append(el.serialize_lib())
+            lines.append(fmt(el))
         for el in texts:
             lines.append(el.serialize_lib())
         for el in rectangles:
-            lines.append(el.serialize_lib())
+            lines.append(fmt(el))
         for el in polylines:
-            lines.append(el.serialize_lib())
+            # simplifier keeps count of points, run it every time
+            lines.append(el.serialize_lib(simplifier) if simplifier else fmt(el))
         for el in pins:
-            lines.append(el.serialize_lib())
+            lines.append(fmt(el))
         lines.append('ENDDRAW')
         lines.append('ENDDEF')
         return '\n'.join(lines)
@@ -642,11 +963,17 @@ class Symbol:
 
 
 class Library:
-    def __init__(self, body):
+    def __init__(self, body, report=None, loads=None):
+        # With loads, body holds entry texts, parsed here so that report
+        # charges tokenizing to the symbols too
         self.symbols = {}
         symbols = {}
         ordinal = 0
         for entry in body:
+            if report:
+                start = perf_counter()
+            if loads:
+                entry = loads(entry)
             e_type = entry[0].value()
             if e_type == 'symbol':
                 e_name = entry[1]
@@ -658,6 +985,8 @@ class Library:
                 else:
                     name = e_name
                 sym = Symbol(libname, name, entry[2:])
+                if report:
+                    report.parsed(sym, perf_counter() - start)
                 symbols[name] = ordinal, sym
                 ordinal += 1
         for _, sym in symbols.values():
@@ -666,7 +995,7 @@ class Library:
                 symbols[sym.extends][1].aliases.append(sym.name)
         self.symbols = symbols
 
-    def serialize_lib(self, cache_lib=False):
+    def serialize_lib(self, cache_lib=False, report=None, simplifier=None, memo=None):
         syms_order = list(filter(lambda x: not x[1].extends, self.symbols.values()))
         syms_order.sort()
         header = '''\
@@ -677,9 +1006,17 @@ EESchema-LIBRARY Version 2.4
 #
 #End Library
 '''
-        return header + '\n'.join([sym.serialize_lib(cache_lib) for _, sym in syms_order]) + footer
-
-    def serialize_dcm(self):
+        entries = []
+        for _, sym in syms_order:
+            if report:
+                start = perf_counter()
+            text = sym.serialize_lib(cache_lib, simplifier, memo)
+            if report:
+                report.serialized(sym, perf_counter() - start, text)
+            entries.append(text)
+        return header + '\n'.join(entries) + footer
+
+    def serialize_dcm(self, report=None):
         syms_order = list(self.symbols.values())
         syms_order.sort()
         header = '''\
@@ -689,7 +1026,14 @@ EESchema-DOCLIB  Version 2.0
 #
 #End Doc Library
 '''
-        entries = [sym.serialize_dcm() for _, sym in syms_order]
+        entries = []
+        for _, sym in syms_order:
+            if report:
+                start = perf_counter()
+            text = sym.serialize_dcm()
+            if report:
+                report.serialized(sym, perf_counter() - start, text)
+            entries.append(text)
         return header + '\n'.join([x for x in entries if x]) + footer
 
 
@@ -789,13 +1133,35 @@ class Label(SchObject):
 
 
 class Schematics:
-    def __init__(self):
+    sch_header = '''\
+EESchema Schematic File Version 4
+EELAYER 30 0
+EELAYER END
+$Descr A4 11693 8268
+encoding utf-8
+Sheet 1 1
+Title ""
+Date ""
+Rev ""
+Comp ""
+Comment1 ""
+Comment2 ""
+Comment3 ""
+Comment4 ""
+$EndDescr
+'''
+    sch_footer = '\n$EndSCHEMATC\n'
+
+    def __init__(self, short_id=0):
         self.junctions = []
         self.no_connects = []
         self.wires = []
         self.labels = []
         self.symbols = []
-        self.short_id = int(time())
+        # time stamp for symbols without uuid
+        self.short_id = short_id
+        # time stamps given so far, they must be unique in the sheet
+        self.used_ids = set()
         self.name = None
 
     def parse_entry(self, entry):
@@ -827,51 +1193,308 @@ class Schematics:
             else:
                 raise NameError("There is not e_name")  # name = e_name
             sym = Symbol(libname, name, entry[2:])
-            sym.short_id = self.short_id
-            self.short_id += 1
+            try:
+                # Legacy time stamp is the uuid tail, the same way
+                # KiCad makes uuids from time stamps of legacy files
+                stamp = int(sym.uuid.replace('-', '')[-8:], 16)
+                counted = False
+            except ValueError:
+                stamp = self.short_id
+                counted = True
+            # On a collision take the next free stamp, in parse order
+            # to stay reproducible
+            while stamp in self.used_ids:
+                stamp = (stamp + 1) & 0xffffffff
+            self.used_ids.add(stamp)
+            if counted:
+                self.short_id = (stamp + 1) & 0xffffffff
+            sym.short_id = stamp
             self.symbols.append(sym)
         elif e_type == 'path':
             pass
 
     def serialize_sch(self):
-        header = '''\
-EESchema Schematic File Version 4
-EELAYER 30 0
-EELAYER END
-$Descr A4 11693 8268
-encoding utf-8
-Sheet 1 1
-Title ""
-Date ""
-Rev ""
-Comp ""
-Comment1 ""
-Comment2 ""
-Comment3 ""
-Comment4 ""
-$EndDescr
-'''
-        footer = '\n$EndSCHEMATC\n'
         lines = []
         lines += [obj.serialize_sch() for obj in self.junctions]
         lines += [obj.serialize_sch() for obj in self.no_connects]
         lines += [obj.serialize_sch() for obj in self.wires]
         lines += [obj.serialize_sch() for obj in self.labels]
         lines += [obj.serialize_sch() for obj in self.symbols]
-        return header + '\n'.join(lines) + footer
-
-
-def main():
-    global body
-    if len(sys.argv) < 2:
-        print("Usage: kicad_backport.py FILE_NAME")
-        return 1
-    fn = sys.argv[1]
-    with open(fn, "rt") as f:
-        text = f.read()
-    sexpr = sexpdata.loads(text)
-    is_schematics = False
+        return self.sch_header + '\n'.join(lines) + self.sch_footer
+
+
+# Streaming schematics
+# Objects are serialized into per-category spools as soon as they are
+# parsed, so memory use doesn't depend on sheet size.
+
+class SpoolList:
+    """Stand-in for an object list that only keeps serialized objects"""
+    # serialized objects are written to the spool in pieces of this size
+    piece_size = 64 * 1024
+
+    def __init__(self, max_size):
+        self.spool = tempfile.SpooledTemporaryFile(max_size, mode='w+', encoding='utf-8',
+                                                   newline='')
+        self.count = 0
+        self.piece = []
+        self.piece_len = 0
+
+    def append(self, obj):
+        text = obj.serialize_sch()
+        self.piece.append(text)
+        self.piece_len += len(text)
+        self.count += 1
+        if self.piece_len >= self.piece_size:
+            self.flush()
+
+    def flush(self):
+        if self.piece:
+            if self.spool.tell():
+                self.spool.write('\n')
+            self.spool.write('\n'.join(self.piece))
+            self.piece = []
+            self.piece_len = 0
+
+    def __len__(self):
+        return self.count
+
+    def copy_to(self, f):
+        self.flush()
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, f)
+
+    def close(self):
+        self.spool.close()
+
+
+class SpooledSchematics(Schematics):
+    """Schematics keeping every category in a SpoolList.
+
+    Spools stay in memory up to spool_size characters each, and go to
+    temporary files beyond that.
+    """
+    def __init__(self, short_id=0, spool_size=1024 * 1024):
+        super().__init__(short_id)
+        self.junctions = SpoolList(spool_size)
+        self.no_connects = SpoolList(spool_size)
+        self.wires = SpoolList(spool_size)
+        self.labels = SpoolList(spool_size)
+        self.symbols = SpoolList(spool_size)
+
+    def categories(self):
+        # in serialize_sch order
+        return [self.junctions, self.no_connects, self.wires, self.labels, self.symbols]
+
+    def write_sch(self, f):
+        f.write(self.sch_header)
+        first = True
+        for spool in self.categories():
+            if not spool:
+                continue
+            if not first:
+                f.write('\n')
+            spool.copy_to(f)
+            first = False
+        f.write(self.sch_footer)
+
+    def close(self):
+        for spool in self.categories():
+            spool.close()
+
+
+_paren_re = re.compile(r'"(?:[^"\\]|\\.)*"|[()]')
+_head_re = re.compile(r'\s*([^\s()"]+)')
+
+
+def file_loads(fixed=False):
+    """Parser for parts of one file, fixed-point ones share atom caches"""
+    if not fixed:
+        return sexpdata.loads
+    symbols = {}
+    lengths = {}
+
+    def loads(text):
+        return loads_fixed(text, symbols, lengths)
+    return loads
+
+
+def iter_child_texts(lines):
+    """Yield head of the top-level list, then texts of its child lists.
+
+    Only the text of the child being read is kept. Strings are expected
+    not to span lines, KiCad escapes line breaks in them.
+    """
+    depth = 0
+    parts = []  # text of the current child
+    head = None
+    for line in lines:
+        if depth >= 2 and '"' not in line:
+            closing = line.count(')')
+            if closing < depth - 1:
+                # the line can't end the child, no need to look closer
+                depth += line.count('(') - closing
+                parts.append(line)
+                continue
+        start = 0 if depth >= 2 else None
+        for m in _paren_re.finditer(line):
+            c = m.group()
+            if c == '(':
+                depth += 1
+                if depth == 1:
+                    head = _head_re.match(line, m.end())
+                    head = head.group(1) if head else ''
+                    yield head
+                elif depth == 2:
+                    start = m.start()
+            elif c == ')':
+                depth -= 1
+                if depth == 1:
+                    parts.append(line[start:m.end()])
+                    yield ''.join(parts)
+                    parts = []
+                    start = None
+                elif depth == 0:
+                    return
+        if start is not None:
+            parts.append(line[start:])
+
+
+_string_re = re.compile(r'"(?:[^"\\]|\\.)*"')
+_list_start_re = re.compile(r'\(\s*([^\s()"]*)')
+
+
+def iter_child_groups(lines):
+    """Like iter_child_texts, but a text may hold several child lists.
+
+    Texts are cut where a line ends between children, which is found by
+    counting parentheses of the whole line instead of walking them one
+    by one. This assumes nothing follows the top-level list.
+    """
+    depth = 0
+    parts = []  # text of the current group
+    for line in lines:
+        if not depth:
+            m = _list_start_re.search(line)
+            if not m:
+                continue
+            yield m.group(1)
+            line = line[m.end():]
+            depth = 1
+        bare = _string_re.sub('', line) if '"' in line else line
+        end = depth + bare.count('(') - bare.count(')')
+        if end > 0:
+            parts.append(line)
+            depth = end
+            if depth == 1:
+                yield ''.join(parts)
+                parts = []
+            continue
+        # the top-level list ends on this line
+        for m in _paren_re.finditer(line):
+            c = m.group()
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    parts.append(line[:m.start()])
+                    break
+        yield ''.join(parts)
+        return
+
+
+def iter_children(lines, fixed=False, batch_size=64 * 1024):
+    """Yield head of the top-level list, then its child lists one by one.
+
+    Children are parsed in batches of about batch_size characters, which
+    saves the parser start-up cost per child. Only the text of the batch
+    being read is kept.
+    """
+    loads = file_loads(fixed)
+    texts = iter_child_groups(lines)
+    head = next(texts, None)
+    if head is None:
+        return
+    yield head
+    batch = []  # texts of children read since the last parse
+    size = 0
+    for child in texts:
+        batch.append(child)
+        size += len(child)
+        if size >= batch_size:
+            yield from loads('(' + '\n'.join(batch) + ')')
+            batch = []
+            size = 0
+    if batch:
+        yield from loads('(' + '\n'.join(batch) + ')')
+
+
+def file_seed(fn):
+    """content_seed() of file contents, read in chunks"""
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return int.from_bytes(h.digest()[:4], 'big')
+
+
+def stream_schematics(fn, output, fixed=False, simplifier=None, memo=None,
+                      spool_size=1024 * 1024):
+    """Convert kicad_sch file fn keeping memory use bounded.
+
+    lib_symbols goes to the library converter on its own as soon as it
+    is read, the rest is spooled by SpooledSchematics. Outputs are the
+    same as from serialize(). Returns False, without writing anything,
+    if fn is not a schematics.
+    """
+    with open(fn, "rt", encoding='utf-8') as f:
+        children = iter_children(f, fixed)
+        if next(children, None) != 'kicad_sch':
+            return False
+        fn_base, _ = os.path.splitext(fn)
+        schematics = SpooledSchematics(file_seed(fn), spool_size)
+        try:
+            lib_symbols = []
+            for entry in children:
+                if entry[0].value() == 'lib_symbols':
+                    lib_symbols = entry[1:]
+                    break
+                schematics.parse_entry(entry)
+            # cache library doesn't wait for the rest of the sheet
+            library = Library(lib_symbols)
+            with output.open(fn_base + '-cache.lib') as lib:
+                lib.write(library.serialize_lib(True, None, simplifier, memo))
+            library = lib_symbols = None
+            for entry in children:
+                schematics.parse_entry(entry)
+            with output.open(fn_base + '.sch') as sch:
+                schematics.write_sch(sch)
+        finally:
+            schematics.close()
+    return True
+
+
+def content_seed(data):
+    """Time stamp seed for schematics symbols derived from file contents"""
+    return int.from_bytes(hashlib.sha256(data).digest()[:4], 'big')
+
+
+def parse_text(text, fixed=False, short_id=0, report=None):
+    """Parse kicad_sym or kicad_sch text.
+
+    Returns (library, schematics) pair, schematics is None for a symbol
+    library, or None if the text is neither a symbol library nor
+    a schematics.
+    fixed selects the fixed-point parser, short_id seeds time stamps of
+    schematics symbols without uuid, report collects per-symbol costs.
+    """
+    if report:
+        return parse_symbol_texts(text, fixed, short_id, report)
+    sexpr = loads_fixed(text) if fixed else sexpdata.loads(text)
+    if type(sexpr) is not list or not sexpr or type(sexpr[0]) is not sexpdata.Symbol:
+        return None
     schematics = None
+    body = []
     if sexpr[0] == sexpdata.Symbol('kicad_symbol_lib'):
         # KiCad symbol library new format 
         # First element - symbol kicad_symbol_lib
@@ -882,8 +1505,7 @@ def main():
         body = sexpr[1:]
     elif sexpr[0] == sexpdata.Symbol('kicad_sch'):
         # KiCad schematics new format
-        is_schematics = True
-        schematics = Schematics()
+        schematics = Schematics(short_id)
         for entry in sexpr[1:]:
             e_type = entry[0].value()
             if e_type == 'lib_symbols':
@@ -891,26 +1513,1096 @@ def main():
             else:
                 schematics.parse_entry(entry)
     else:
-        print("Invalid symbol lib")
-        return 2
-    library = Library(body)
-    fn_base, _ = os.path.splitext(fn)
-    if is_schematics:
-        fn_lib = fn_base + '-cache.lib'
+        return None
+    return Library(body, report), schematics
+
+
+def parse_symbol_texts(text, fixed, short_id, report):
+    """parse_text() tokenizing every library symbol on its own"""
+    loads = file_loads(fixed)
+    children = iter_child_texts(text.splitlines(True))
+    head = next(children, None)
+    if head == 'kicad_symbol_lib':
+        return Library(children, report, loads), None
+    if head != 'kicad_sch':
+        return None
+    schematics = Schematics(short_id)
+    body = []
+    for child in children:
+        entry_head = _head_re.match(child, 1)
+        if entry_head and entry_head.group(1) == 'lib_symbols':
+            body = iter_child_texts(child.splitlines(True))
+            next(body)
+        else:
+            schematics.parse_entry(loads(child))
+    return Library(body, report, loads), schematics
+
+
+def serialize(library, schematics=None, report=None, simplifier=None, memo=None):
+    """Serialize parsed library and schematics.
+
+    Returns list of (suffix, content) pairs, where suffix is appended to
+    the input file name without extension.
+    """
+    if schematics:
+        return [('-cache.lib', library.serialize_lib(True, report, simplifier, memo)),
+                ('.sch', schematics.serialize_sch())]
+    return [('.lib', library.serialize_lib(False, report, simplifier, memo)),
+            ('.dcm', library.serialize_dcm(report))]
+
+
+def convert_text(text, fixed=False, short_id=0):
+    """Convert kicad_sym or kicad_sch text.
+
+    Returns list of (suffix, content) pairs like serialize(), or None if
+    the text is neither a symbol library nor a schematics.
+    """
+    parsed = parse_text(text, fixed, short_id)
+    if parsed is None:
+        return None
+    return serialize(*parsed)
+
+
+def convert(source, writers=None, fixed=False, short_id=None):
+    """Convert kicad_sym or kicad_sch in memory.
+
+    source is bytes, str or a file-like object opened in text or binary
+    mode, the format is detected from its contents. Returns dict from
+    output suffix ('.lib' and '.dcm' for a symbol library, '-cache.lib'
+    and '.sch' for schematics) to content. If writers maps a suffix to
+    a file-like object or a callable, that output is also written there,
+    encoded to UTF-8 for binary streams.
+
+    Nothing is shared between calls, so it is safe to call from several
+    threads at once. Schematics symbol time stamps come from their uuids,
+    for symbols without one they are seeded from short_id or, unless
+    given, from the source contents. The same source always gives the
+    same output.
+
+    Raises ValueError if source is neither a symbol library nor
+    a schematics, or can't be parsed.
+    """
+    if hasattr(source, 'read'):
+        source = source.read()
+    if isinstance(source, bytes):
+        data = source
+        source = source.decode('utf-8')
+    else:
+        data = source.encode('utf-8')
+    if short_id is None:
+        short_id = content_seed(data)
+    try:
+        converted = convert_text(source, fixed, short_id)
+    except ValueError:
+        raise
+    except Exception as e:
+        # sexpdata asserts on bad syntax, and the model indexes entries
+        # without checking their shape
+        raise ValueError(f'Malformed source: {e!r}') from e
+    if converted is None:
+        raise ValueError('Neither kicad_symbol_lib nor kicad_sch')
+    result = dict(converted)
+    for suffix, content in converted:
+        writer = writers.get(suffix) if writers else None
+        if writer is None:
+            continue
+        if not hasattr(writer, 'write'):
+            writer(content)
+        elif isinstance(writer, (io.RawIOBase, io.BufferedIOBase)):
+            writer.write(content.encode('utf-8'))
+        else:
+            writer.write(content)
+    return result
+
+
+# Symbol catalog
+# Lightweight pass over symbol library that doesn't build drawing primitives
+
+catalog_fields = ['library', 'name', 'extends', 'units', 'styles', 'pins',
+                  'reference', 'keywords', 'description', 'fp_filters']
+
+# property name -> catalog field
+catalog_properties = {
+    'Reference': 'reference',
+    'ki_keywords': 'keywords',
+    'ki_description': 'description',
+    'ki_fp_filters': 'fp_filters'
+}
+
+
+def catalog_record(library, name):
+    record = dict.fromkeys(catalog_fields, '')
+    record['library'] = library
+    record['name'] = name.split(':')[-1]
+    return record
+
+
+def catalog_field(record, el):
+    """Fill record from a property or extends entry of the symbol"""
+    e_type = el[0].value()
+    if e_type == 'property':
+        field = catalog_properties.get(el[1])
+        if field:
+            record[field] = el[2]
+    elif e_type == 'extends':
+        record['extends'] = el[1]
+
+
+def catalog_units(record, units):
+    """Fill unit, style and pin counts from (sub-symbol name, pins) pairs"""
+    numbers = set()
+    styles = set()
+    pins = 0
+    for name, count in units:
+        # units are named like in Symbol.parse
+        parts = name.split('_')
+        numbers.add(int(parts[-2]))
+        styles.add(int(parts[-1]))
+        pins += count
+    # Unit and style 0 are shared by all of them
+    record['units'] = max(numbers, default=0) or 1
+    record['styles'] = max(styles, default=0) or 1
+    record['pins'] = pins
+
+
+def catalog_inherit(records):
+    """Derived symbols get unit, style and pin counts of their parents"""
+    for record in records.values():
+        parent = records.get(record['extends'])
+        if parent:
+            for field in ('units', 'styles', 'pins'):
+                record[field] = parent[field]
+    return list(records.values())
+
+
+# string (group 1), list start with its head (group 2) or list end
+_catalog_re = re.compile(r'("(?:[^"\\]|\\.)*")|\(\s*([^\s()"]*)|\)')
+
+
+def catalog_text(text, library='', fixed=False):
+    """Catalog records of kicad_sym text, or of symbols cached in kicad_sch.
+
+    Returns list of dicts with catalog_fields, or None if the text is
+    neither a symbol library nor a schematics. Derived symbols get unit,
+    DeMorgan style and pin counts of the symbol they extend. Only
+    property and extends entries are parsed, unit sub-symbols are
+    scanned for their names and pin heads.
+    """
+    loads = loads_fixed if fixed else sexpdata.loads
+    records = {}
+    depth = 0
+    top = None  # depth of symbol entries
+    record = None  # symbol being read
+    units = []  # [name, pins] of its sub-symbols
+    unit = None  # sub-symbol being read
+    start = None  # start of property or extends being read
+    want = None  # what the next string names
+    root = None
+    for m in _catalog_re.finditer(text):
+        string, head = m.groups()
+        if string is not None:
+            if want == 'symbol':
+                record = catalog_record(library, loads(string))
+            elif want == 'unit':
+                unit[0] = loads(string)
+            want = None
+            continue
+        want = None
+        if head is None:
+            if top is None:
+                pass
+            elif depth == top + 1:
+                if start is not None:
+                    catalog_field(record, loads(text[start:m.end()]))
+                    start = None
+                unit = None
+            elif depth == top and record is not None:
+                catalog_units(record, units)
+                records[record['name']] = record
+                record = None
+            depth -= 1
+            if depth == 0 or (depth == 1 and top == 3):
+                break
+            continue
+        depth += 1
+        if depth == 1:
+            root = head
+            if root == 'kicad_symbol_lib':
+                top = 2
+            elif root != 'kicad_sch':
+                return None
+        elif top is None:
+            if depth == 2 and head == 'lib_symbols':
+                top = 3
+        elif depth == top:
+            if head == 'symbol':
+                want = 'symbol'
+                units = []
+        elif record is None:
+            continue
+        elif depth == top + 1:
+            if head == 'symbol':
+                unit = ['', 0]
+                units.append(unit)
+                want = 'unit'
+            elif head in ('property', 'extends'):
+                start = m.start()
+        elif depth == top + 2 and unit is not None and head == 'pin':
+            unit[1] += 1
+    if root is None:
+        return None
+    return catalog_inherit(records)
+
+
+def expand_inputs(paths, extensions):
+    """Replace directories in paths by files with extensions found in them"""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith(extensions):
+                    files.append(os.path.join(dirpath, name))
+    return files
+
+
+def write_catalog(records, f=sys.stdout, fmt='tsv'):
+    if fmt == 'json':
+        # JSON lines, one record per symbol
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        return
+    for record in records:
+        f.write('\t'.join(' '.join(str(record[field]).split())
+                          for field in catalog_fields) + '\n')
+
+
+class CostReport:
+    """Per-symbol parse and serialize costs, to find pathological parts"""
+    element_types = {cls: name for name, cls in Unit.element_map.items()}
+    columns = (['file', 'symbol', 'total_time', 'parse_time', 'serialize_time'] +
+               list(Unit.element_map) + ['polyline_points', 'output_bytes'])
+
+    def __init__(self):
+        self.rows = {}
+        # input file of the symbols being recorded
+        self.file = ''
+
+    def row(self, sym):
+        key = self.file, sym.name
+        row = self.rows.get(key)
+        if row is None:
+            row = dict.fromkeys(self.columns, 0)
+            row['file'] = self.file
+            row['symbol'] = sym.name
+            self.rows[key] = row
+        return row
+
+    def parsed(self, sym, seconds):
+        row = self.row(sym)
+        row['parse_time'] += seconds
+        row['total_time'] += seconds
+        for unit in sym.units:
+            for element in unit.elements:
+                row[self.element_types[type(element)]] += 1
+                if type(element) == Polyline:
+                    row['polyline_points'] += len(element.pts)
+
+    def serialized(self, sym, seconds, text):
+        row = self.row(sym)
+        row['serialize_time'] += seconds
+        row['total_time'] += seconds
+        row['output_bytes'] += len(text.encode('utf-8'))
+
+    def top(self, n, column='total_time'):
+        return sorted(self.rows.values(), key=lambda row: row[column], reverse=True)[:n]
+
+    def print_top(self, n, column='total_time', f=sys.stdout):
+        f.write(f'{"parse ms":>9} {"ser ms":>9} {"pins":>6} {"elements":>8} '
+                f'{"points":>7} {"bytes":>9}  symbol\n')
+        for row in self.top(n, column):
+            elements = sum(row[name] for name in Unit.element_map)
+            f.write(f'{row["parse_time"] * 1000:9.3f} {row["serialize_time"] * 1000:9.3f} '
+                    f'{row["pin"]:6} {elements:8} {row["polyline_points"]:7} '
+                    f'{row["output_bytes"]:9}  {row["file"]}:{row["symbol"]}\n')
+
+    def write(self, fn):
+        """Dump the full table, as JSON if fn ends with .json, CSV otherwise"""
+        with open(fn, "wt", newline='') as f:
+            if fn.lower().endswith('.json'):
+                json.dump(list(self.rows.values()), f, indent=1)
+            else:
+                writer = csv.DictWriter(f, self.columns)
+                writer.writeheader()
+                writer.writerows(self.rows.values())
+
+
+class ParseCache:
+    """On-disk cache of parsed (library, schematics) pairs.
+
+    Entries are pickled and keyed by input path, size, mtime and content
+    hash. Least recently used entries are evicted once the directory
+    grows over max_size bytes. Only point it to a directory you trust,
+    entries are unpickled.
+    """
+    version = 3
+    suffix = '.pickle'
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None  # total size of entries, scanned on first put
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, data, fixed=False):
+        st = os.stat(path)
+        h = hashlib.sha256()
+        h.update(f'{self.version}\0{os.path.abspath(path)}\0{st.st_size}\0'
+                 f'{st.st_mtime_ns}\0{int(fixed)}\0'.encode('utf-8'))
+        h.update(hashlib.sha256(data).digest())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        fn = self.entry_path(key)
+        try:
+            with open(fn, 'rb') as f:
+                parsed = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated, or written by an incompatible version
+            self.remove(fn)
+            return None
+        try:
+            # Entry mtime is the recency for LRU eviction
+            os.utime(fn)
+        except OSError:
+            # evicted by another process meanwhile
+            pass
+        return parsed
+
+    def remove(self, fn):
+        try:
+            size = os.path.getsize(fn)
+            os.remove(fn)
+        except OSError:
+            return
+        if self.size is not None:
+            self.size -= size
+
+    def put(self, key, parsed):
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(parsed, f, pickle.HIGHEST_PROTOCOL)
+            entry_size = f.tell()
+        fn = self.entry_path(key)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        try:
+            # entry being replaced
+            self.size -= os.path.getsize(fn)
+        except OSError:
+            pass
+        os.replace(tmp, fn)
+        self.size += entry_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        # [(mtime, size, path)] of all cache entries
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                fn = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, fn))
+        return result
+
+    def evict(self):
+        entries = self.entries()
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, fn in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                continue
+            total -= size
+        self.size = total
+
+
+def load_file(fn, fixed=False, cache=None, report=None):
+    """Parse file like parse_text(), going through cache if given"""
+    with open(fn, "rb") as f:
+        data = f.read()
+    if cache:
+        key = cache.key(fn, data, fixed)
+        parsed = cache.get(key)
+        if parsed is not None:
+            return parsed
+    parsed = parse_text(data.decode('utf-8'), fixed, content_seed(data), report)
+    if cache and parsed is not None:
+        cache.put(key, parsed)
+    return parsed
+
+
+def verify_fixed(text):
+    """Convert text with both parsers.
+
+    Returns list of (suffix, line number, float line, fixed-point line)
+    for every output line that differs.
+    """
+    short_id = content_seed(text.encode('utf-8'))
+    expected = convert_text(text, False, short_id)
+    actual = convert_text(text, True, short_id)
+    if expected is None:
+        return []
+    diffs = []
+    for (suffix, content), (_, fixed_content) in zip(expected, actual):
+        lines = content.split('\n')
+        fixed_lines = fixed_content.split('\n')
+        for n, (line, fixed_line) in enumerate(zip(lines, fixed_lines)):
+            if line != fixed_line:
+                diffs.append((suffix, n + 1, line, fixed_line))
+        if len(lines) != len(fixed_lines):
+            diffs.append((suffix, min(len(lines), len(fixed_lines)) + 1,
+                          f'{len(lines)} lines', f'{len(fixed_lines)} lines'))
+    return diffs
+
+
+# Classic format reader
+# Streaming parser of EESchema-LIBRARY and EESchema-DOCLIB files as
+# written above, used to check conversion results
+
+_classic_token_re = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+_classic_field_re = re.compile(r'F(\d+) "((?:[^"\\]|\\.)*)" (.*)$')
+
+
+def iter_lib(lines):
+    """Yield dict per symbol from lines of EESchema-LIBRARY file.
+
+    Dict has name, def (DEF line tokens after DEF), fields (field number
+    to list of text and other tokens), aliases, fplist and draw (list of
+    token lists, one per DRAW record).
+    """
+    sym = None
+    header = True
+    in_draw = False
+    in_fplist = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if header:
+            if not line.startswith('EESchema-LIBRARY Version 2.'):
+                raise ValueError(f'Not a symbol library: {line[:40]}')
+            header = False
+            continue
+        if not line or line[0] == '#':
+            continue
+        if in_draw:
+            if line == 'ENDDRAW':
+                in_draw = False
+            else:
+                sym['draw'].append(_classic_token_re.findall(line))
+        elif in_fplist:
+            if line == '$ENDFPLIST':
+                in_fplist = False
+            else:
+                sym['fplist'] += line.split()
+        elif line.startswith('DEF '):
+            tokens = line.split()
+            sym = {'name': tokens[1], 'def': tokens[1:], 'fields': {},
+                   'aliases': [], 'fplist': [], 'draw': []}
+        elif line == 'ENDDEF':
+            yield sym
+            sym = None
+        elif line.startswith('F'):
+            m = _classic_field_re.match(line)
+            if m:
+                text = m.group(2).replace('\\"', '"')
+                sym['fields'][int(m.group(1))] = [text] + _classic_token_re.findall(m.group(3))
+        elif line.startswith('ALIAS '):
+            sym['aliases'] = line.split()[1:]
+        elif line == '$FPLIST':
+            in_fplist = True
+        elif line == 'DRAW':
+            in_draw = True
+
+
+def iter_dcm(lines):
+    """Yield (name, doc) from lines of EESchema-DOCLIB file.
+
+    doc maps D, K and F record letters to their text.
+    """
+    name = None
+    doc = {}
+    header = True
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if header:
+            if not line.startswith('EESchema-DOCLIB'):
+                raise ValueError(f'Not a doc library: {line[:40]}')
+            header = False
+        elif line.startswith('$CMP '):
+            name = line[5:]
+            doc = {}
+        elif line == '$ENDCMP':
+            yield name, doc
+            name = None
+        elif name is not None and line[:2] in ('D ', 'K ', 'F '):
+            doc[line[0]] = line[2:]
+
+
+# Differential verification
+# Both the parsed model and the re-read classic output are reduced to
+# comparable aspects: tuples of strings, or sorted lists of them.
+
+def model_aspects(sym, cache_lib=False):
+    # Values are rounded the same way serialize_lib rounds them, so that
+    # only real conversion errors show up
+    name = sym.libname + '_' + sym.name if cache_lib else sym.name
+    # units without elements of their own can't be seen in kicad_sym
+    n_units = max((unit.n_unit for unit in sym.units if unit.n_unit > 0), default=1)
+    aspects = {
+        'DEF': (name, sym.reference.text, str(mils(sym.pin_numbers_offset)),
+                str(mils(sym.pin_names_offset)),
+                'N' if sym.pin_numbers_hide else 'Y',
+                'N' if sym.pin_names_hide else 'Y', str(n_units),
+                'L' if sym.locked else 'F', 'P' if sym.power else 'N'),
+        'ALIAS': sorted(sym.aliases),
+        '$FPLIST': sym.fplist.text.split() if sym.fplist else []
+    }
+    props = [sym.reference, sym.value, sym.footprint, sym.datasheet]
+    for n, prop in enumerate(props):
+        # datasheet goes to dcm
+        text = prop.text if n < 3 else ''
+        aspects[f'F{n}'] = (text, str(mils(prop.at[0])), str(mils(prop.at[1])),
+                            str(mils(prop.effects.font_size[0])),
+                            'I' if prop.effects.hide else 'V')
+    draw = {tag: [] for tag in 'ACPSTX'}
+    for unit in sym.units:
+        for el in unit.elements:
+            u = str(el.n_unit), str(el.n_subunit)
+            if type(el) == Pin:
+                style = ('N' if el.hidden else '') + Pin.pin_style_map[el.pin_style]
+                draw['X'].append((el.name, str(el.number or 1), str(mils(el.at[0])),
+                                  str(mils(el.at[1])), str(mils(el.length)),
+                                  'RULD'[int((el.at[2] + 45) / 90) % 4],
+                                  str(mils(el.number_effects.font_size[0])),
+                                  str(mils(el.name_effects.font_size[0]))) + u +
+                                 (Pin.pin_type_map[el.pin_type], style))
+            elif type(el) == Rectangle:
+                draw['S'].append((str(mils(el.start[0])), str(mils(el.start[1])),
+                                  str(mils(el.end[0])), str(mils(el.end[1]))) + u +
+                                 (str(mils(el.stroke_width)), el.lib_get_fill_type()))
+            elif type(el) == Circle:
+                draw['C'].append((str(mils(el.center[0])), str(mils(el.center[1])),
+                                  str(mils(el.radius))) + u +
+                                 (str(mils(el.stroke_width)), el.lib_get_fill_type()))
+            elif type(el) == Arc:
+                draw['A'].append((str(mils(el.radius_at[0])), str(mils(el.radius_at[1])),
+                                  str(mils(el.radius_len)),
+                                  str(int(el.radius_angles[0] * 10)),
+                                  str(int(el.radius_angles[1] * 10))) + u +
+                                 (str(mils(el.stroke_width)), el.lib_get_fill_type(),
+                                  str(mils(el.start[0])), str(mils(el.start[1])),
+                                  str(mils(el.end[0])), str(mils(el.end[1]))))
+            elif type(el) == Polyline:
+                pts = tuple(str(mils(v)) for pt in el.pts for v in pt)
+                draw['P'].append((str(len(el.pts)),) + u +
+                                 (str(mils(el.stroke_width)), el.lib_get_fill_type()) + pts)
+            elif type(el) == Text:
+                draw['T'].append((str(el.at[2]), str(mils(el.at[0])), str(mils(el.at[1])),
+                                  str(mils(el.effects.font_size[0]))) + u +
+                                 (el.text, el.effects.justify_x[0].upper(),
+                                  el.effects.justify_y[0].upper()))
+    for tag, records in draw.items():
+        aspects[tag] = sorted(records)
+    return aspects
+
+
+def classic_aspects(sym):
+    d = sym['def']
+    aspects = {
+        'DEF': tuple(d[:9]),
+        'ALIAS': sorted(sym['aliases']),
+        '$FPLIST': sym['fplist']
+    }
+    for n in range(4):
+        f = sym['fields'].get(n)
+        aspects[f'F{n}'] = (f[0], f[1], f[2], f[3], f[5]) if f else None
+    draw = {tag: [] for tag in 'ACPSTX'}
+    for t in sym['draw']:
+        tag = t[0]
+        if tag == 'X':
+            draw[tag].append(tuple(t[1:12]) + (t[12] if len(t) > 12 else '',))
+        elif tag == 'S':
+            draw[tag].append(tuple(t[1:9]))
+        elif tag == 'C':
+            draw[tag].append(tuple(t[1:8]))
+        elif tag == 'A':
+            draw[tag].append(tuple(t[1:14]))
+        elif tag == 'P':
+            draw[tag].append(tuple(t[1:5]) + (t[-1],) + tuple(t[5:-1]))
+        elif tag == 'T':
+            draw[tag].append((t[1], t[2], t[3], t[4], t[6], t[7], t[8].strip('"'), t[11], t[12]))
+    for tag, records in draw.items():
+        aspects[tag] = sorted(records)
+    return aspects
+
+
+def model_doc(sym):
+    doc = {}
+    for letter, prop in (('D', sym.description), ('K', sym.keywords), ('F', sym.datasheet)):
+        if prop and prop.text:
+            doc[letter] = prop.text
+    return doc
+
+
+def compare_aspects(expected, actual):
+    """Yield description of every aspect that differs"""
+    for key, value in expected.items():
+        got = actual.get(key)
+        if value == got:
+            continue
+        if isinstance(value, list) and isinstance(got, list):
+            missing = list((Counter(value) - Counter(got)).elements())
+            extra = list((Counter(got) - Counter(value)).elements())
+            if missing:
+                yield f'{key}: {len(missing)} missing, first {" ".join(missing[0])}'
+            if extra:
+                yield f'{key}: {len(extra)} unexpected, first {" ".join(extra[0])}'
+            if not (missing or extra):
+                yield f'{key}: expected {value}, got {got}'
+        else:
+            yield f'{key}: expected {value}, got {got}'
+
+
+def verify_file(fn, fixed=False):
+    """Convert fn, read outputs back and compare them with parsed model.
+
+    Only .lib/-cache.lib and .dcm outputs are checked. Returns list of
+    mismatch descriptions, empty if everything matches.
+    """
+    try:
+        parsed = load_file(fn, fixed)
+        if parsed is None:
+            return [f'{fn}: invalid symbol lib']
+        library, schematics = parsed
+        outputs = dict(serialize(library, schematics))
+        cache_lib = schematics is not None
+        lib = outputs['-cache.lib' if cache_lib else '.lib']
+        classic = {sym['name']: sym for sym in iter_lib(lib.splitlines())}
+        docs = dict(iter_dcm(outputs['.dcm'].splitlines())) if not cache_lib else {}
+    except Exception as e:
+        # keep going over the rest of the corpus
+        return [f'{fn}: {type(e).__name__}: {e}']
+    messages = []
+    for _, sym in library.symbols.values():
+        expected = model_aspects(sym, cache_lib)
+        name = expected['DEF'][0]
+        if not cache_lib:
+            doc = model_doc(sym)
+            if doc != docs.get(sym.name, {}):
+                messages.append(f'{fn}: {sym.name}: dcm: expected {doc}, got {docs.get(sym.name)}')
+        if sym.extends:
+            # written as ALIAS of the parent
+            continue
+        actual = classic.pop(name, None)
+        if actual is None:
+            messages.append(f'{fn}: {name}: missing')
+            continue
+        for diff in compare_aspects(expected, classic_aspects(actual)):
+            messages.append(f'{fn}: {name}: {diff}')
+    for name in classic:
+        messages.append(f'{fn}: {name}: unexpected')
+    return messages
+
+
+# Output destinations for converted files
+
+class ChangedFileWriter:
+    """Binary file writer that leaves the file alone if content is the same.
+
+    Written data is compared with the existing file as it comes, nothing
+    touches the disk while it matches. Once it differs, the matching part
+    and the rest go to a temporary file next to the target, which is
+    synced and renamed over it on close.
+    """
+    chunk_size = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.tmp = None
+        self.matched = 0  # bytes equal to the existing file so far
+        try:
+            self.old = open(path, "rb")
+        except FileNotFoundError:
+            self.old = None
+            self.start_tmp()
+
+    def start_tmp(self):
+        self.tmp = open(self.tmp_path, "wb")
+        if self.old:
+            self.old.seek(0)
+            left = self.matched
+            while left:
+                data = self.old.read(min(left, self.chunk_size))
+                self.tmp.write(data)
+                left -= len(data)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.tmp is None:
+            if self.old.read(len(data)) == data:
+                self.matched += len(data)
+                return
+            self.start_tmp()
+        self.tmp.write(data)
+
+    def close(self):
+        if self.tmp is None and self.old.read(1):
+            # existing file is longer
+            self.start_tmp()
+        if self.old:
+            self.old.close()
+        if self.tmp is None:
+            return
+        self.tmp.flush()
+        os.fsync(self.tmp.fileno())
+        self.tmp.close()
+        if self.old:
+            shutil.copymode(self.path, self.tmp_path)
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        if self.old:
+            self.old.close()
+        if self.tmp:
+            self.tmp.close()
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class FileOutput:
+    """Write every converted file next to its input.
+
+    With if_changed files with the same content are left untouched and
+    the rest are replaced atomically.
+    """
+    def __init__(self, if_changed=False):
+        self.if_changed = if_changed
+
+    def open(self, name):
+        """Text stream for converted file name"""
+        if self.if_changed:
+            return ChangedFileWriter(name)
+        # same bytes as ChangedFileWriter and archives on every platform
+        return open(name, "wt", encoding='utf-8', newline='\n')
+
+    def write(self, name, content):
+        with self.open(name) as f:
+            f.write(content)
+
+    def close(self):
+        pass
+
+
+class TarMember:
+    """Text stream spooled until close, since tar needs member size first"""
+    def __init__(self, archive, name, mtime, spool_size=1024 * 1024):
+        self.archive = archive
+        self.info = tarfile.TarInfo(name)
+        self.info.mtime = mtime
+        self.spool = tempfile.SpooledTemporaryFile(spool_size)
+
+    def write(self, text):
+        self.spool.write(text.encode('utf-8'))
+
+    def close(self):
+        self.info.size = self.spool.tell()
+        self.spool.seek(0)
+        self.archive.addfile(self.info, self.spool)
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.spool.close()
+
+
+class ArchiveNameError(ValueError):
+    pass
+
+
+def archive_base(files):
+    """Directory archive member names are relative to.
+
+    Current directory if it holds all files, their common parent otherwise.
+    """
+    dirs = [os.path.dirname(os.path.abspath(fn)) for fn in files]
+    cwd = os.getcwd()
+    if all(os.path.commonpath([cwd, d]) == cwd for d in dirs):
+        return cwd
+    return os.path.commonpath(dirs)
+
+
+class ArchiveOutput:
+    """Stream every converted file into a single zip or tar archive"""
+    # archive name suffix -> (kind, mode)
+    formats = [
+        ('.zip', ('zip', zipfile.ZIP_DEFLATED)),
+        ('.tar', ('tar', 'w')),
+        ('.tar.gz', ('tar', 'w:gz')),
+        ('.tgz', ('tar', 'w:gz')),
+        ('.tar.bz2', ('tar', 'w:bz2')),
+        ('.tbz2', ('tar', 'w:bz2')),
+        ('.tar.xz', ('tar', 'w:xz')),
+        ('.txz', ('tar', 'w:xz')),
+    ]
+
+    def __init__(self, path, compress=True, base='.'):
+        kind = None
+        for suffix, fmt in self.formats:
+            if path.lower().endswith(suffix):
+                kind, mode = fmt
+        if kind is None:
+            raise ValueError(f'Unknown archive type: {path}')
+        if not compress and mode not in (zipfile.ZIP_DEFLATED, 'w'):
+            # a plain tar under a compressed name can't be read back
+            raise ValueError(f"Can't store uncompressed in {path}, use .zip or .tar")
+        self.kind = kind
+        self.base = os.path.abspath(base)
+        self.names = set()
+        self.mtime = time()
+        if kind == 'zip':
+            self.archive = zipfile.ZipFile(path, 'w', mode if compress else zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(path, mode if compress else 'w')
+
+    def member_name(self, name):
+        """Name of converted file in the archive, relative to base"""
+        parts = os.path.relpath(os.path.abspath(name), self.base).split(os.sep)
+        if '..' in parts:
+            raise ArchiveNameError(f'{name} is outside of {self.base}')
+        member = '/'.join(parts)
+        if member in self.names:
+            raise ArchiveNameError(f'Duplicate archive member: {member}')
+        self.names.add(member)
+        return member
+
+    def open(self, name):
+        """Text stream for converted file name, added to archive on close"""
+        name = self.member_name(name)
+        if self.kind == 'zip':
+            info = zipfile.ZipInfo(name, localtime(self.mtime)[:6])
+            info.compress_type = self.archive.compression
+            return io.TextIOWrapper(self.archive.open(info, 'w'), 'utf-8', newline='')
+        return TarMember(self.archive, name, self.mtime)
+
+    def write(self, name, content):
+        data = content.encode('utf-8')
+        name = self.member_name(name)
+        if self.kind == 'zip':
+            info = zipfile.ZipInfo(name, localtime(self.mtime)[:6])
+            info.compress_type = self.archive.compression
+            with self.archive.open(info, 'w') as f:
+                f.write(data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Port kicad_sym and kicad_sch back to classic formats')
+    parser.add_argument('files', metavar='FILE_NAME', nargs='+',
+                        help='.kicad_sym or .kicad_sch file to convert')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='only list symbols, one line per symbol: ' +
+                             ', '.join(catalog_fields) +
+                             '; directories are searched for .kicad_sym files')
+    parser.add_argument('--list-format', choices=['tsv', 'json'], default='tsv',
+                        help='tab separated fields or JSON lines (default %(default)s)')
+    parser.add_argument('-a', '--archive', metavar='ARCHIVE',
+                        help='write all converted files into a single archive '
+                             '(.zip, .tar, .tar.gz, .tar.bz2 or .tar.xz) '
+                             'instead of next to the inputs')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='store archive members uncompressed (.zip and .tar only)')
+    parser.add_argument('--write-if-changed', action='store_true',
+                        help='leave output files with the same content untouched, '
+                             'replace the others atomically')
+    parser.add_argument('--simplify', action='store_true',
+                        help='drop repeated and collinear polyline points')
+    parser.add_argument('--simplify-tolerance', metavar='MILS', type=int, default=0,
+                        help='also drop points of unfilled polylines closer than '
+                             'MILS to the simplified line, implies --simplify')
+    parser.add_argument('--memo', metavar='N', type=int, default=0,
+                        help='reuse serialized text of up to N most recently seen '
+                             'distinct fields, pins and pen primitives')
+    parser.add_argument('--memo-stats', action='store_true',
+                        help='print --memo hit rates')
+    parser.add_argument('--stream', action='store_true',
+                        help='convert schematics object by object, keeping memory use '
+                             'bounded regardless of sheet size')
+    parser.add_argument('--fixed', action='store_true',
+                        help='decode coordinates to integer nanometers at parse time')
+    parser.add_argument('--verify-fixed', action='store_true',
+                        help='only check that --fixed gives the same output, '
+                             'nothing is written')
+    parser.add_argument('--verify', action='store_true',
+                        help='only convert in memory, read the results back and '
+                             'compare them with the source symbols; directories '
+                             'are searched for .kicad_sym and .kicad_sch files')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='parallel --verify processes (default: CPU count)')
+    parser.add_argument('--report', metavar='N', type=int,
+                        help='print N most expensive symbols, disables --cache')
+    parser.add_argument('--report-sort', metavar='COLUMN', default='total_time',
+                        choices=[c for c in CostReport.columns if c not in ('file', 'symbol')],
+                        help='report column to rank symbols by (default %(default)s)')
+    parser.add_argument('--report-file', metavar='FILE',
+                        help='write full per-symbol report to FILE, JSON if it ends '
+                             'with .json, CSV otherwise; disables --cache')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep parsed inputs in DIR to skip parsing on later runs')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=512,
+                        help='evict least recently used cache entries above this size '
+                             '(default %(default)s)')
+    args = parser.parse_args()
+    if args.list:
+        status = 0
+        if args.list_format == 'tsv':
+            sys.stdout.write('\t'.join(catalog_fields) + '\n')
+        for fn in expand_inputs(args.files, ('.kicad_sym',)):
+            with open(fn, "rb") as f:
+                text = f.read().decode('utf-8')
+            records = catalog_text(text, fn, args.fixed)
+            if records is None:
+                sys.stderr.write(f"Invalid symbol lib: {fn}\n")
+                status = 2
+                continue
+            write_catalog(records, sys.stdout, args.list_format)
+        return status
+    if args.verify:
+        files = expand_inputs(args.files, ('.kicad_sym', '.kicad_sch'))
+        failed = 0
+        with ProcessPoolExecutor(args.jobs) as executor:
+            for messages in executor.map(verify_file, files, repeat(args.fixed), chunksize=4):
+                for message in messages:
+                    print(message)
+                if messages:
+                    failed += 1
+        print(f'{failed} of {len(files)} files differ')
+        return 3 if failed else 0
+    if args.verify_fixed:
+        status = 0
+        for fn in args.files:
+            with open(fn, "rt") as f:
+                text = f.read()
+            diffs = verify_fixed(text)
+            for suffix, n, line, fixed_line in diffs:
+                print(f'{fn}: {suffix}:{n}: float "{line}" fixed "{fixed_line}"')
+            if diffs:
+                status = 3
+        return status
+    if args.archive:
+        try:
+            output = ArchiveOutput(args.archive, not args.no_compress,
+                                   archive_base(args.files))
+        except ValueError as e:
+            print(e)
+            return 1
     else:
-        fn_lib = fn_base + '.lib'
-    with open(fn_lib, "wt") as f:
-        f.write(library.serialize_lib(is_schematics))
-    if is_schematics:
-        fn_sch = fn_base + '.sch'
-        with open(fn_sch, "wt") as f:
-            f.write(schematics.serialize_sch())
-    if not is_schematics:
-        fn_dcm = fn_base + '.dcm'
-        with open(fn_dcm, "wt") as f:
-            f.write(library.serialize_dcm())
-    return 0
+        output = FileOutput(args.write_if_changed)
+    simplifier = None
+    if args.simplify or args.simplify_tolerance:
+        simplifier = PolylineSimplifier(args.simplify_tolerance)
+    memo = None
+    if args.memo > 0:
+        memo = SerializeMemo(args.memo)
+    report = None
+    if args.report is not None or args.report_file:
+        # parse time is only known for symbols actually parsed
+        report = CostReport()
+    cache = None
+    if args.cache and not report:
+        cache = ParseCache(args.cache, args.cache_size * 1024 * 1024)
+    if args.stream and (args.cache or report):
+        # streamed schematics are never fully parsed, only kicad_sym
+        # files get them
+        sys.stderr.write('Warning: --cache and --report apply to .kicad_sym files only '
+                         'with --stream\n')
+    status = 0
+    try:
+        for fn in args.files:
+            try:
+                if args.stream and stream_schematics(fn, output, args.fixed, simplifier, memo):
+                    continue
+                if report:
+                    report.file = fn
+                parsed = load_file(fn, args.fixed, cache, report)
+                if parsed is None:
+                    print(f"Invalid symbol lib: {fn}")
+                    status = 2
+                    continue
+                fn_base, _ = os.path.splitext(fn)
+                for suffix, content in serialize(*parsed, report, simplifier, memo):
+                    output.write(fn_base + suffix, content)
+            except ArchiveNameError as e:
+                print(e)
+                status = 1
+    finally:
+        output.close()
+    if memo and args.memo_stats:
+        memo.print_stats()
+    if simplifier:
+        print(f'Polylines: {simplifier.points_in - simplifier.points_out} '
+              f'of {simplifier.points_in} points removed')
+    if report:
+        if args.report is not None:
+            report.print_top(args.report, args.report_sort)
+        if args.report_file:
+            report.write(args.report_file)
+    return status
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    # Run this file as module kicad_backport, whatever the file is named,
+    # so that pickled cache entries refer to kicad_backport classes
+    # rather than __main__ ones
+    spec = importlib.util.spec_from_file_location('kicad_backport', __file__)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['kicad_backport'] = module
+    spec.loader.exec_module(module)
+    sys.exit(module.main())